@@ -1,8 +1,35 @@
 import streamlit as st
 import gspread
+from gspread.utils import absolute_range_name
 from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
 import pandas as pd
-from datetime import datetime
+import pyarrow as pa
+import random
+import threading
+from time import sleep
+
+# Column headers written to row 1 of an empty sheet
+SHEET_HEADERS = ["Patient ID", "Antibiotic", "Dosage", "Date", "Time", "Added By"]
+HEADER_RANGE = "A1:F1"
+
+# Free-text columns that must never be parsed as formulas, numbers or dates
+TEXT_COLUMNS = {"Patient ID", "Antibiotic", "Dosage", "Added By"}
+
+# Formats used when writing entries; Date is parsed with it for the latest-entry metric
+DATE_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%H:%M:%S"
+
+# Queued entries are written in one call once this many are pending
+PENDING_FLUSH_THRESHOLD = 20
+
+# Retry settings for rate-limited (HTTP 429) Google API calls
+MAX_RETRY_ATTEMPTS = 5
+MAX_RETRY_DELAY = 32.0
+
+# Maximum Google API calls in flight at once across all sessions (a concurrency
+# bound only; it does not cap calls per minute against the Sheets quota)
+MAX_CONCURRENT_API_CALLS = 5
 
 # Page configuration
 st.set_page_config(
@@ -32,6 +59,14 @@ def get_google_sheet_client():
         )
         
         client = gspread.authorize(credentials)
+        
+        # Pool keep-alive connections to sheets.googleapis.com across reruns,
+        # sized to the API semaphore so every in-flight call gets a pooled connection
+        adapter = HTTPAdapter(
+            pool_connections=MAX_CONCURRENT_API_CALLS,
+            pool_maxsize=MAX_CONCURRENT_API_CALLS
+        )
+        client.http_client.session.mount("https://", adapter)
         return client, None
         
     except KeyError as e:
@@ -43,30 +78,118 @@ def get_google_sheet_client():
         st.error(f"❌ {error_msg}")
         return None, error_msg
 
+@st.cache_resource(show_spinner=False)
+def get_api_semaphore():
+    """Process-wide semaphore bounding concurrent Google API calls"""
+    return threading.BoundedSemaphore(MAX_CONCURRENT_API_CALLS)
+
+def with_backoff(fn, *args, **kwargs):
+    """Call fn, retrying with exponential backoff while Google returns HTTP 429"""
+    semaphore = get_api_semaphore()
+    delay = 1.0
+    for attempt in range(MAX_RETRY_ATTEMPTS):
+        try:
+            # Hold a slot only for the call itself, not while backing off
+            with semaphore:
+                return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            # Sheets sends no Retry-After header, so fall back to jittered backoff
+            status_code = getattr(e.response, "status_code", None)
+            if status_code != 429 or attempt == MAX_RETRY_ATTEMPTS - 1:
+                raise
+            sleep(delay + random.random() * 0.3)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+@st.cache_resource(show_spinner=False)
+def get_spreadsheet(sheet_id):
+    """Open and return the Spreadsheet handle, reused across reruns"""
+    client, error = get_google_sheet_client()
+    if error:
+        raise RuntimeError(error)
+    return with_backoff(client.open_by_key, sheet_id)
+
+@st.cache_resource(show_spinner=False)
+def get_worksheet(sheet_id, worksheet_name="Sheet1"):
+    """Open and return the Worksheet handle, reused across reruns"""
+    return with_backoff(get_spreadsheet(sheet_id).worksheet, worksheet_name)
+
+@st.cache_data(show_spinner=False)
+def _parse_sheet_id(sheet_url):
+    """Extract Sheet ID from a Sheet URL or bare ID"""
+    # Extract ID from URL if it's a full URL
+    if "docs.google.com/spreadsheets" in sheet_url:
+        if "/d/" in sheet_url:
+            return sheet_url.split("/d/")[1].split("/")[0], None
+        return None, "Invalid Sheet URL format"
+    
+    # Assume it's already just the ID
+    return sheet_url, None
+
 def get_sheet_id():
     """Extract Sheet ID from secrets"""
     try:
         if "sheets" not in st.secrets or "url" not in st.secrets["sheets"]:
             return None, "Sheet URL not configured in secrets"
         
-        sheet_url = st.secrets["sheets"]["url"]
-        
-        # Extract ID from URL if it's a full URL
-        if "docs.google.com/spreadsheets" in sheet_url:
-            if "/d/" in sheet_url:
-                sheet_id = sheet_url.split("/d/")[1].split("/")[0]
-            else:
-                return None, "Invalid Sheet URL format"
-        else:
-            # Assume it's already just the ID
-            sheet_id = sheet_url
-        
-        return sheet_id, None
+        return _parse_sheet_id(st.secrets["sheets"]["url"])
         
     except Exception as e:
         return None, f"Error extracting Sheet ID: {str(e)}"
 
-def read_sheet(sheet_id, worksheet_name="Sheet1"):
+@st.cache_data(show_spinner=False)
+def get_service_account_email():
+    """Read the service account email from secrets"""
+    try:
+        return st.secrets["gcp_service_account"]["client_email"], None
+    except Exception as e:
+        return None, str(e)
+
+def _skip_blank_rows(values):
+    """Drop blank rows above the header; the Sheets API keeps leading empty rows"""
+    first_row = next((i for i, row in enumerate(values) if any(row)), len(values))
+    return values[first_row:]
+
+def _get_sheet_values(worksheet):
+    """Fetch every row of a worksheet in one request, without blank leading rows"""
+    return _skip_blank_rows(with_backoff(worksheet.get))
+
+def _values_to_frame(values):
+    """Build an Arrow-backed DataFrame of strings from raw Sheets values"""
+    header, rows = values[0], values[1:]
+    
+    # Duplicate labels would make df[column] return a frame and break the metrics
+    duplicates = sorted({name for name in header if header.count(name) > 1})
+    if duplicates:
+        return None, f"Duplicate column headers in sheet: {duplicates}"
+    
+    # The Sheets API trims trailing empty cells, so pad short rows while transposing
+    columns = [
+        pa.array([row[i] if i < len(row) else "" for row in rows], type=pa.string())
+        for i in range(len(header))
+    ]
+    table = pa.Table.from_arrays(columns, names=header)
+    return table.to_pandas(types_mapper=pd.ArrowDtype), None
+
+def _latest_date(dates):
+    """Latest date in a column of Sheets text, falling back to the newest row"""
+    dates = dates[dates.str.strip() != ""]
+    if dates.empty:
+        return "N/A"
+    
+    # Fixed-format parsing takes the fast path; cache=True memoizes repeated dates
+    parsed = pd.to_datetime(dates, format=DATE_FORMAT, errors="coerce", cache=True)
+    
+    # Cells in the sheet's own display format (USER_ENTERED rows) need the flexible parser
+    unparsed = parsed.isna()
+    if unparsed.any():
+        parsed[unparsed] = pd.to_datetime(dates[unparsed], format="mixed", errors="coerce", cache=True)
+    
+    # Only trust the max when every cell parsed; otherwise the newest row is the latest entry
+    if parsed.notna().all():
+        return parsed.max().strftime(DATE_FORMAT)
+    return dates.iloc[-1]
+
+def _read_sheet_uncached(sheet_id, worksheet_name="Sheet1"):
     """Read data from Google Sheet"""
     try:
         client, error = get_google_sheet_client()
@@ -78,7 +201,7 @@ def read_sheet(sheet_id, worksheet_name="Sheet1"):
         
         # Try to open the spreadsheet
         try:
-            sheet = client.open_by_key(sheet_id)
+            sheet = get_spreadsheet(sheet_id)
         except gspread.exceptions.SpreadsheetNotFound:
             return None, f"Spreadsheet not found. Please verify:\n1. Sheet ID is correct: {sheet_id}\n2. Sheet is shared with service account"
         except gspread.exceptions.APIError as e:
@@ -86,31 +209,97 @@ def read_sheet(sheet_id, worksheet_name="Sheet1"):
         
         # Try to get the worksheet
         try:
-            worksheet = sheet.worksheet(worksheet_name)
+            worksheet = get_worksheet(sheet_id, worksheet_name)
         except gspread.exceptions.WorksheetNotFound:
             return None, f"Worksheet '{worksheet_name}' not found. Available worksheets: {[ws.title for ws in sheet.worksheets()]}"
         
-        # Get all records
-        data = worksheet.get_all_records()
+        values = _get_sheet_values(worksheet)
         
-        if not data:
+        if not values:
             return pd.DataFrame(), None
         
-        return pd.DataFrame(data), None
+        return _values_to_frame(values)
         
     except Exception as e:
         return None, f"Unexpected error: {str(e)}"
 
+@st.cache_data(ttl=60, show_spinner=False)
+def _read_sheet_frame_cached(sheet_id, worksheet_name="Sheet1"):
+    """Read data from Google Sheet, raising on failure so errors are never cached"""
+    df, error = _read_sheet_uncached(sheet_id, worksheet_name)
+    if error:
+        raise RuntimeError(error)
+    return df
+
+def read_sheet_cached(sheet_id, worksheet_name="Sheet1"):
+    """Read data from Google Sheet, served from cache for 60 seconds"""
+    try:
+        return _read_sheet_frame_cached(sheet_id, worksheet_name), None
+    except RuntimeError as e:
+        return None, str(e)
+
+def read_many_sheets(sheet_id, worksheet_names):
+    """Read several worksheets of one spreadsheet in a single batchGet call"""
+    try:
+        client, error = get_google_sheet_client()
+        if error:
+            return None, error
+        
+        sheet = get_spreadsheet(sheet_id)
+        value_ranges = with_backoff(
+            sheet.values_batch_get,
+            [absolute_range_name(name) for name in worksheet_names]
+        )["valueRanges"]
+        
+        frames = {}
+        for name, value_range in zip(worksheet_names, value_ranges):
+            values = _skip_blank_rows(value_range.get("values", []))
+            if not values:
+                frames[name] = pd.DataFrame()
+                continue
+            
+            frames[name], error = _values_to_frame(values)
+            if error:
+                return None, f"Worksheet '{name}': {error}"
+        
+        return frames, None
+        
+    except gspread.exceptions.SpreadsheetNotFound:
+        return None, "Spreadsheet not found"
+    except Exception as e:
+        return None, f"Error reading worksheets: {str(e)}"
+
+def as_sheet_text(value):
+    """Quote a free-text value so USER_ENTERED stores it as literal text"""
+    # A leading apostrophe stops Sheets from parsing formulas, numbers and dates
+    return f"'{value}" if value else value
+
+def as_sheet_row(row_data):
+    """Quote the free-text columns of a row; Date and Time are left for Sheets to parse"""
+    return [
+        as_sheet_text(value) if i < len(SHEET_HEADERS) and SHEET_HEADERS[i] in TEXT_COLUMNS else value
+        for i, value in enumerate(row_data)
+    ]
+
 def append_to_sheet(sheet_id, row_data, worksheet_name="Sheet1"):
     """Append a row to Google Sheet"""
+    return append_rows_to_sheet(sheet_id, [row_data], worksheet_name)
+
+def append_rows_to_sheet(sheet_id, rows, worksheet_name="Sheet1"):
+    """Append several rows to Google Sheet in a single API call"""
     try:
         client, error = get_google_sheet_client()
         if error:
             return False, error
         
-        sheet = client.open_by_key(sheet_id)
-        worksheet = sheet.worksheet(worksheet_name)
-        worksheet.append_row(row_data)
+        worksheet = get_worksheet(sheet_id, worksheet_name)
+        # USER_ENTERED lets Sheets type Date/Time, so free text must be quoted here
+        with_backoff(
+            worksheet.append_rows,
+            [as_sheet_row(row) for row in rows],
+            value_input_option="USER_ENTERED",
+            insert_data_option="INSERT_ROWS"
+        )
         
         return True, None
         
@@ -128,13 +317,11 @@ def initialize_sheet_if_empty(sheet_id, worksheet_name="Sheet1"):
         if error:
             return False, error
         
-        sheet = client.open_by_key(sheet_id)
-        worksheet = sheet.worksheet(worksheet_name)
+        worksheet = get_worksheet(sheet_id, worksheet_name)
         
-        # Check if sheet is empty
-        if not worksheet.get_all_values():
-            headers = ["Patient ID", "Antibiotic", "Dosage", "Date", "Time", "Added By"]
-            worksheet.append_row(headers)
+        # Check if sheet is empty, the same way the read path does
+        if not _get_sheet_values(worksheet):
+            with_backoff(worksheet.update, values=[SHEET_HEADERS], range_name=HEADER_RANGE)
             return True, "Headers added successfully"
         
         return True, None
@@ -159,43 +346,39 @@ with st.sidebar:
     st.success("✅ Sheet ID loaded")
     st.code(sheet_id, language=None)
     
-    # Display service account email
-    try:
-        service_account_email = st.secrets["gcp_service_account"]["client_email"]
-        st.info(f"**Service Account:**")
-        st.code(service_account_email, language=None)
+    # Setup details are tucked away; the Sheet ID above stays visible at a glance
+    with st.expander("🔧 Setup info", expanded=False):
+        service_account_email, email_error = get_service_account_email()
         
-        st.warning("⚠️ **Setup Checklist:**")
-        st.markdown("""
-        1. ✓ Google Sheets API enabled
-        2. ✓ Google Drive API enabled
-        3. ✓ Share Sheet with service account
-        4. ✓ Grant Editor permissions
-        """)
-        
-    except Exception as e:
-        st.error(f"❌ Error reading service account: {e}")
+        if email_error:
+            st.error(f"❌ Error reading service account: {email_error}")
+        else:
+            st.info(f"**Service Account:**")
+            st.code(service_account_email, language=None)
+            
+            st.warning("⚠️ **Setup Checklist:**")
+            st.markdown("""
+            1. ✓ Google Sheets API enabled
+            2. ✓ Google Drive API enabled
+            3. ✓ Share Sheet with service account
+            4. ✓ Grant Editor permissions
+            """)
     
     # Test connection button
     if st.button("🔍 Test Connection", use_container_width=True):
         with st.spinner("Testing connection..."):
-            client, error = get_google_sheet_client()
-            if error:
-                st.error(f"❌ Connection failed: {error}")
+            # _read_sheet_uncached reports authentication failures through its error too
+            df, read_error = _read_sheet_uncached(sheet_id)
+            if read_error:
+                st.error(f"❌ Cannot access sheet: {read_error}")
             else:
-                st.success("✅ Connected successfully!")
-                
-                # Try to access the sheet
-                df, read_error = read_sheet(sheet_id)
-                if read_error:
-                    st.error(f"❌ Cannot access sheet: {read_error}")
-                else:
-                    st.success("✅ Sheet accessible!")
+                st.success("✅ Connected & sheet accessible!")
     
     # Initialize sheet button
     if st.button("🔄 Initialize Sheet Headers", use_container_width=True):
         success, msg = initialize_sheet_if_empty(sheet_id)
         if success:
+            _read_sheet_frame_cached.clear()
             st.success("✅ Sheet initialized!")
             if msg:
                 st.info(msg)
@@ -205,89 +388,128 @@ with st.sidebar:
 # Main content area
 st.divider()
 
-# Read and display data
-st.subheader("📊 Current Entries")
-
-with st.spinner("Loading data from Google Sheets..."):
-    df, error = read_sheet(sheet_id)
-
-if error:
-    st.error(f"❌ Error loading data: {error}")
-    st.info("💡 **Troubleshooting Tips:**")
-    st.markdown("""
-    1. Verify the Google Sheet is shared with the service account email (shown in sidebar)
-    2. Make sure the Sheet ID is correct
-    3. Check that the sheet has a worksheet named 'Sheet1'
-    4. Click 'Test Connection' in the sidebar to diagnose the issue
-    """)
-else:
-    if df.empty:
-        st.info("📝 No entries yet. Add your first entry below!")
-        st.info("💡 Tip: Click 'Initialize Sheet Headers' in the sidebar if the sheet is empty")
+@st.fragment
+def entries_view(sheet_id):
+    """Entries table, metrics and entry form; reruns on its own after a submit"""
+    # Read and display data
+    st.subheader("📊 Current Entries")
+    
+    with st.spinner("Loading data from Google Sheets..."):
+        df, error = read_sheet_cached(sheet_id)
+    
+    if error:
+        st.error(f"❌ Error loading data: {error}")
+        st.info("💡 **Troubleshooting Tips:**")
+        st.markdown("""
+        1. Verify the Google Sheet is shared with the service account email (shown in sidebar)
+        2. Make sure the Sheet ID is correct
+        3. Check that the sheet has a worksheet named 'Sheet1'
+        4. Click 'Test Connection' in the sidebar to diagnose the issue
+        """)
     else:
-        st.dataframe(df, use_container_width=True, height=400)
+        if df.empty:
+            st.info("📝 No entries yet. Add your first entry below!")
+            st.info("💡 Tip: If the sheet has no header row yet, click 'Initialize Sheet Headers' in the sidebar")
+        else:
+            # Only ship the newest rows to the browser; metrics below still use the full df
+            rows_to_show = st.slider("Rows to show", 50, 2000, 200, step=50)
+            view = df.tail(rows_to_show).iloc[::-1]
+            st.dataframe(view, use_container_width=True, height=400)
+            
+            # Display summary statistics, computed in a single agg pass
+            aggregations = {
+                column: how
+                for column, how in [("Antibiotic", "nunique"), ("Patient ID", "nunique")]
+                if column in df.columns
+            }
+            stats = df.agg(aggregations) if aggregations else {}
+            
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("📋 Total Entries", len(df))
+            with col2:
+                if "Antibiotic" in stats:
+                    st.metric("💊 Unique Antibiotics", stats["Antibiotic"])
+            with col3:
+                if "Patient ID" in stats:
+                    st.metric("👤 Unique Patients", stats["Patient ID"])
+            with col4:
+                if "Date" in df.columns:
+                    st.metric("📅 Latest Entry", _latest_date(df["Date"]))
+    
+    # Add new entry form
+    st.divider()
+    st.subheader("➕ Add New Entry")
+    
+    with st.form("add_entry", clear_on_submit=True):
+        col1, col2, col3 = st.columns(3)
         
-        # Display summary statistics
-        col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("📋 Total Entries", len(df))
+            patient_id = st.text_input("Patient ID*", placeholder="e.g., ICU-001")
+            antibiotic = st.text_input("Antibiotic*", placeholder="e.g., Ceftriaxone")
+        
         with col2:
-            if "Antibiotic" in df.columns:
-                st.metric("💊 Unique Antibiotics", df["Antibiotic"].nunique())
+            dosage = st.text_input("Dosage*", placeholder="e.g., 1g IV")
+            date = st.date_input("Date*")
+        
         with col3:
-            if "Patient ID" in df.columns:
-                st.metric("👤 Unique Patients", df["Patient ID"].nunique())
-        with col4:
-            if "Date" in df.columns:
-                st.metric("📅 Latest Entry", df["Date"].max() if not df["Date"].empty else "N/A")
-
-# Add new entry form
-st.divider()
-st.subheader("➕ Add New Entry")
-
-with st.form("add_entry", clear_on_submit=True):
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        patient_id = st.text_input("Patient ID*", placeholder="e.g., ICU-001")
-        antibiotic = st.text_input("Antibiotic*", placeholder="e.g., Ceftriaxone")
-    
-    with col2:
-        dosage = st.text_input("Dosage*", placeholder="e.g., 1g IV")
-        date = st.date_input("Date*")
-    
-    with col3:
-        time = st.time_input("Time*")
-        added_by = st.text_input("Added By", placeholder="Your name")
-    
-    col_submit1, col_submit2 = st.columns([3, 1])
-    with col_submit2:
-        submitted = st.form_submit_button("✅ Submit Entry", use_container_width=True, type="primary")
-    
-    if submitted:
-        # Validate required fields
-        if not patient_id or not antibiotic or not dosage:
-            st.error("⚠️ Please fill in all required fields (marked with *)")
-        else:
-            with st.spinner("Adding entry..."):
+            time = st.time_input("Time*")
+            added_by = st.text_input("Added By", placeholder="Your name")
+        
+        col_submit1, col_submit2, col_submit3 = st.columns([2, 1, 1])
+        with col_submit2:
+            queued = st.form_submit_button("🕒 Queue Entry", use_container_width=True)
+        with col_submit3:
+            submitted = st.form_submit_button("✅ Submit Entry", use_container_width=True, type="primary")
+        
+        if submitted or queued:
+            # Validate required fields
+            if not patient_id or not antibiotic or not dosage:
+                st.error("⚠️ Please fill in all required fields (marked with *)")
+            else:
                 row_data = [
                     patient_id,
                     antibiotic,
                     dosage,
-                    str(date),
-                    str(time),
+                    date.isoformat(),
+                    time.strftime(TIME_FORMAT),
                     added_by if added_by else "Unknown"
                 ]
                 
-                success, error = append_to_sheet(sheet_id, row_data)
-                
-                if success:
-                    st.success("✅ Entry added successfully!")
-                    st.balloons()
-                    # Refresh the page to show new data
-                    st.rerun()
+                if queued:
+                    st.session_state.setdefault("pending", []).append(row_data)
+                    st.info(f"🕒 Entry queued, not saved yet ({len(st.session_state.pending)} pending)")
                 else:
-                    st.error(f"❌ Failed to add entry: {error}")
+                    with st.spinner("Adding entry..."):
+                        success, error = append_to_sheet(sheet_id, row_data)
+                    
+                    if success:
+                        st.success("✅ Entry added successfully!")
+                        st.balloons()
+                        # Drop the cached read and rerun only this fragment to show the new row
+                        _read_sheet_frame_cached.clear()
+                        st.rerun(scope="fragment")
+                    else:
+                        st.error(f"❌ Failed to add entry: {error}")
+    
+    # Write queued entries in a single batch
+    pending = st.session_state.get("pending", [])
+    if pending:
+        st.warning(f"⚠️ {len(pending)} queued entries are not saved yet. They are lost if this tab is closed before flushing.")
+        st.dataframe(pd.DataFrame(pending, columns=SHEET_HEADERS), use_container_width=True)
+        flush = st.button(f"📤 Flush {len(pending)} pending entries", type="primary")
+        if flush or (queued and len(pending) >= PENDING_FLUSH_THRESHOLD):
+            with st.spinner("Saving queued entries..."):
+                success, error = append_rows_to_sheet(sheet_id, pending)
+            
+            if success:
+                st.session_state.pending = []
+                _read_sheet_frame_cached.clear()
+                st.rerun(scope="fragment")
+            else:
+                st.error(f"❌ Failed to save queued entries: {error}")
+
+entries_view(sheet_id)
 
 # Footer
 st.divider()